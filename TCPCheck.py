@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # Copyright (c) 2020 Arista Networks, Inc.  All rights reserved.
 # Arista Networks, Inc. Confidential and Proprietary.
 '''
@@ -30,8 +30,13 @@ daemon TCPCheck
 This requires the EOS SDK extension installed if its < EOS 4.17.0 release.
 All new EOS releases include the SDK.
 
+If the optional re2 (google-re2) Python module is installed, REGEX is matched with RE2, which runs
+in linear time. Otherwise the standard re module is used.
+
 Config Option explanation:
     - CHECKINTERVAL is the time in seconds to check the HTTP/S Neighbor(s). Default is 5 seconds.
+    After a failed check, the neighbor is checked every CHECKINTERVAL/4 seconds (minimum 1 second)
+    until it recovers or FAILCOUNT is reached.
     - FAILCOUNT is the number of times/iterations that the neighbor must fail before
 declaring the neighbor is down and executing config changes. This is optional. The default is 2.
     - IPv4 is the address to check. Mandatory parameter.
@@ -82,6 +87,8 @@ in your config change files. This is because, the EOS SDK eAPI interation module
 # Version 2.3.1  - 05/30/2020 - Jeremy Georges -- jgeorges@arista.com -- Added additional exception handling and File Descriptor cleanup.
 #                                                                        Changed Syslog to LOCAL4 so logs show up in EOS logs.
 # Version 2.3.2 -  04/23/2021 - J. Georges -- Added verbose error logging for applyconfig
+# Version 3.0.0 -  10/15/2026 - Python 3 only. Checks run on a worker thread, response is streamed and
+#                               matched incrementally, options and the request are cached, TLS 1.2/1.3.
 #*************************************************************************************
 #
 #
@@ -89,7 +96,15 @@ in your config change files. This is because, the EOS SDK eAPI interation module
 # GLOBAL VARIABLES -        *
 #****************************
 __author__ = 'Jeremy Georges'
-__version__ = '2.3.2'
+__version__ = '3.0.0'
+
+# Syslog messages logged on every state change or failed check
+MSG_HOST_UP = "HTTP host back up. Changing Configuration."
+MSG_HOST_UP_CLEAR = "HTTP host back up. Clearing FAILITERATION semaphore."
+MSG_HOST_DOWN = "HTTP HOST is down. Changing configuration."
+MSG_CHECK_ERROR = "TCPCheck - An exception occurred. Skipping to next interval"
+MSG_CONNECT_TIMEOUT = "Connection Timeout"
+MSG_RESPONSE_TIMEOUT = "HTTP Response Timeout"
 
 
 #****************************
@@ -97,18 +112,81 @@ __version__ = '2.3.2'
 #****************************
 #
 import sys
-import syslog
+import logging
+import logging.handlers
+import queue
 import eossdk
 import re
 import socket
 import base64
 import ssl
 import os
+import contextlib
+import errno
+import selectors
+import time
+import collections
+import concurrent.futures
+try:
+    # RE2 matches in linear time, so a complex REGEX can not backtrack forever on a large
+    # page. It is optional, we fall back to the standard re module if it's not installed.
+    import re2
+except ImportError:
+    re2 = None
+
+# Everything the agent logs goes through this logger. main() sends it to syslog from a
+# QueueListener thread, so a slow /dev/log never blocks the SDK event loop.
+# logging has no level for syslog's notice, so add one.
+NOTICE = 25
+logging.addLevelName(NOTICE, "NOTICE")
+logger = logging.getLogger("TCPCheck")
+
+# What web_check needs to run a check. on_timeout copies it from the agent on the SDK thread
+# when the check starts, so on_agent_option can not change it under the worker thread.
+# conditional is True if the request carries If-None-Match/If-Modified-Since.
+CheckParams = collections.namedtuple("CheckParams",
+    "protocol address hostname timeout regex regexstr request session conditional")
 
 #***************************
 #*     CLASSES          *
 #***************************
-class TCPCheckAgent(eossdk.AgentHandler, eossdk.TimeoutHandler, eossdk.VrfHandler):
+class TCPCheckAgent(eossdk.AgentHandler, eossdk.TimeoutHandler, eossdk.VrfHandler, eossdk.FdHandler):
+    # Agent options we handle, mapped to the status key shown by 'show daemon' and the
+    # value to show when the option is unset. None means show our default below.
+    OPTIONS = {
+        "IPv4": ("IPv4 Address List:", "None"),
+        "PROTOCOL": ("PROTOCOL:", "None"),
+        "TCPPORT": ("TCPPORT:", "None"),
+        "USERNAME": ("USERNAME:", "None"),
+        "PASSWORD": ("PASSWORD:", "None"),
+        "CONF_FAIL": ("CONF_FAIL:", "None"),
+        "CONF_RECOVER": ("CONF_RECOVER:", "None"),
+        "REGEX": ("REGEX:", "None"),
+        "HTTPTIMEOUT": ("HTTPTIMEOUT:", None),
+        "FAILCOUNT": ("FAILCOUNT:", None),
+        "CHECKINTERVAL": ("CHECKINTERVAL:", None),
+        "URLPATH": ("URLPATH:", "/"),
+        "VRF": ("VRF:", "Default"),
+    }
+
+    # These are the defaults. The config can override these
+    # Default check Interval in seconds
+    CHECKINTERVAL = 5
+    # Default number of failures before determining a down neighbor
+    FAILCOUNT = 2
+    # Default HTTP Request timeout in seconds
+    HTTPTIMEOUT = 15
+    # Connect timeout in seconds once checks have started failing
+    CONNECTTIMEOUT = 2
+
+    #Packetbuffer size for socket.recv()
+    PACKETSIZE = 8192
+    # How much already searched data is searched again along with the next read, so a
+    # REGEX match that straddles two reads is still found.
+    MATCHOVERLAP = 1024
+    # Most of a response we read looking for REGEX before giving up on the page.
+    MAXRESPONSE = 1048576
+
     def __init__(self, sdk, timeoutMgr, VrfMgr,EapiMgr):
         self.agentMgr = sdk.get_agent_mgr()
         self.tracer = eossdk.Tracer("TCPCheckPythonAgent")
@@ -118,25 +196,15 @@ class TCPCheckAgent(eossdk.AgentHandler, eossdk.TimeoutHandler, eossdk.VrfHandle
         self.tracer.trace0("Python agent constructed")
         eossdk.VrfHandler.__init__(self, VrfMgr)
         self.VrfMgr = VrfMgr
+        # _vrf_valid is only worked out when VRF is set. Get told about VRFs coming and
+        # going so it is refreshed if our VRF is created or deleted later.
+        self.watch_all_vrfs(True)
         self.EapiMgr= EapiMgr
 
-
-
-        # These are the defaults. The config can override these
-        # Default check Interval in seconds
-        self.CHECKINTERVAL=5
-        #
         # CURRENTSTATUS   1 is Good, 0 is Down
         self.CURRENTSTATUS=1
 
-        # Default number of failures before determining a down neighbor
-        self.FAILCOUNT=2
-        #
-
-        # Default HTTP Request timeout in seconds
-        self.HTTPTIMEOUT=15
-
-        # We need a global variable to use for failure counts. When we reach FAILCOUNT, then we'll
+        # Failure count for the current outage. When we reach FAILCOUNT, then we'll
         # consider host/http down.
         self.FAILITERATION=0
 
@@ -144,16 +212,101 @@ class TCPCheckAgent(eossdk.AgentHandler, eossdk.TimeoutHandler, eossdk.VrfHandle
         # basic configuration check
         self.CONFIGCHECK=1
 
-
-        #Packetbuffer size for socket.recv()
-        self.PACKETSIZE=20000
+        # web_check runs on this single worker thread so it does not block the SDK event
+        # loop. _inflight is the Future of the check in progress, if any, and _check the
+        # CheckParams it was started with. The worker only sees that copy. All agent state
+        # is read and written on the SDK thread.
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._inflight = None
+        self._check = None
+        # A dup of the check's socket. on_agent_enabled shuts it down to stop the check.
+        self._checksock = None
+
+        # When a check finishes the worker writes a byte to this pipe, which wakes the SDK
+        # event loop through on_readable. Nothing has to poll for the result meanwhile.
+        eossdk.FdHandler.__init__(self)
+        self._donefd, self._notifyfd = os.pipe()
+        os.set_blocking(self._donefd, False)
+        self.watch_readable(self._donefd, True)
+
+        # TLS context used for HTTPS checks. Build it once here and reuse it for every
+        # probe instead of having ssl.wrap_socket() create a new context each interval.
+        # Certificates are not verified. Targets are typically addressed by IP with
+        # self-signed certs. Configure that once here, not on every wrap.
+        # PROTOCOL_TLS_CLIENT negotiates the highest version both sides support, so servers
+        # that only accept TLS 1.2 or 1.3 do not show up as down.
+        self._sslcontext = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self._sslcontext.check_hostname = False
+        self._sslcontext.verify_mode = ssl.CERT_NONE
+
+        # TLS session from the last HTTPS check. Offering it on the next connect lets the
+        # server resume the session with an abbreviated handshake.
+        self._tlssession = None
+
+        # Agent options web_check uses on every check. Set by on_agent_option.
+        self._ipv4 = None
+        self._protocol = None
+        self._tcpport = 0
+        self._vrf = ""
+        self._regexstr = None
+        self._finalpath = "/"
+
+        # (IPv4, TCPPORT) for connect, built when either changes. IPv4 must be a literal
+        # address so connect never has to resolve it.
+        self._server_address = (None, 0)
+        self._ipv4_valid = False
+
+        # Whether VRF is set and exists, so a check does not have to ask VrfMgr every time.
+        self._vrf_valid = False
+
+        # The raw HTTP request web_check sends, as bytes. Rebuilt by rebuild_request()
+        # only when an option it depends on changes.
+        self._baserequest = None
+        self._request = None
+        self._regex = None
+
+        # ETag and Last-Modified of the last page where REGEX matched. When set, they are
+        # sent as If-None-Match/If-Modified-Since and a 304 reply counts as a match.
+        self._etag = None
+        self._lastmodified = None
+
+        # HTTPTIMEOUT, FAILCOUNT and CHECKINTERVAL as ints. Set by on_agent_option.
+        self._timeout_int = self.HTTPTIMEOUT
+        self._failcount_int = self.FAILCOUNT
+        self._checkinterval_int = self.CHECKINTERVAL
+
+        # Parsed commands from the CONF_FAIL and CONF_RECOVER files, as (mtime, commands)
+        # keyed by path. Loaded when the option is set so change_config does not have to go
+        # to disk while we are handling a failure, unless the file has been edited since.
+        self._cmd_cache = {}
+
+        # Last value we wrote for each status key, so unchanged values are not pushed
+        # through the SDK again on every check.
+        self._status = {}
+
+        # What on_agent_option does with each option once its status is shown. A new
+        # option needs an entry in OPTIONS and, if the agent uses it, a setter here.
+        self._option_handlers = {
+            "IPv4": self._set_ipv4,
+            "PROTOCOL": self._set_protocol,
+            "TCPPORT": self._set_tcpport,
+            "USERNAME": self._set_request_option,
+            "PASSWORD": self._set_request_option,
+            "URLPATH": self._set_urlpath,
+            "CONF_FAIL": self._set_conf_file,
+            "CONF_RECOVER": self._set_conf_file,
+            "REGEX": self._set_regex,
+            "HTTPTIMEOUT": self._set_httptimeout,
+            "FAILCOUNT": self._set_failcount,
+            "CHECKINTERVAL": self._set_checkinterval,
+            "VRF": self._set_vrf,
+        }
 
 
     def on_initialized(self):
-        global __version__
         self.tracer.trace0("Initialized")
-        syslog.syslog("TCPCheck Version %s Initialized" % __version__)
-        self.agentMgr.status_set("Status:", "Administratively Up")
+        logger.info("TCPCheck Version %s Initialized", __version__)
+        self.set_status("Status:", "Administratively Up")
         # Lets check and set our state for each option during initialization.
         # i.e. after you do a 'no shut' on the daemon, we'll check each of these
         # and set status.
@@ -169,36 +322,12 @@ class TCPCheckAgent(eossdk.AgentHandler, eossdk.TimeoutHandler, eossdk.VrfHandle
         self.on_agent_option("REGEX", self.agentMgr.agent_option("REGEX"))
         self.on_agent_option("URLPATH", self.agentMgr.agent_option("URLPATH"))
         self.on_agent_option("VRF", self.agentMgr.agent_option("VRF"))
-
-
-
-        # Lets check the checkinterval, FAILCOUNT and HTTPTIMEOUT parameters and see if we should override the defaults
-        # Note these are only variables that we have defaults for if user does not
-        # override the value. Everything else, we'll reference the values directly
-        # with agent.Mgr.agent_option("xyz")
-
-        if self.agentMgr.agent_option("CHECKINTERVAL"):
-            self.on_agent_option("CHECKINTERVAL", self.agentMgr.agent_option("CHECKINTERVAL"))
-        else:
-            # global CHECKINTERVAL
-            # We'll just use the default time specified by global variable
-            self.agentMgr.status_set("CHECKINTERVAL:", "%s" % self.CHECKINTERVAL)
-
-
-        if self.agentMgr.agent_option("FAILCOUNT"):
-            self.on_agent_option("FAILCOUNT", self.agentMgr.agent_option("FAILCOUNT"))
-        else:
-            # We'll just use the default failcount specified by global variable
-            self.agentMgr.status_set("FAILCOUNT: ", "%s" % self.FAILCOUNT)
-
-
+        # CHECKINTERVAL, FAILCOUNT and HTTPTIMEOUT have defaults, which on_agent_option
+        # shows in the status if the user does not override them.
+        self.on_agent_option("CHECKINTERVAL", self.agentMgr.agent_option("CHECKINTERVAL"))
+        self.on_agent_option("FAILCOUNT", self.agentMgr.agent_option("FAILCOUNT"))
         # TODO - Perhaps add independent socket & HTTP timeout?
-
-        if self.agentMgr.agent_option("HTTPTIMEOUT"):
-            self.on_agent_option("HTTPTIMEOUT", self.agentMgr.agent_option("HTTPTIMEOUT"))
-        else:
-            # Since agent_option is not set, we'll just use the default HTTPTIMEOUT specified by global variable
-            self.agentMgr.status_set("HTTPTIMEOUT:", "%s" % self.HTTPTIMEOUT)
+        self.on_agent_option("HTTPTIMEOUT", self.agentMgr.agent_option("HTTPTIMEOUT"))
 
 
         # Some basic mandatory variable checks. We'll check this when we have a
@@ -209,172 +338,270 @@ class TCPCheckAgent(eossdk.AgentHandler, eossdk.TimeoutHandler, eossdk.VrfHandle
         else:
             self.CONFIGCHECK = 0
         #Start our handler now.
-        self.agentMgr.status_set("HealthStatus:", "Unknown")
+        self.set_status("HealthStatus:", "Unknown")
         self.timeout_time_is(eossdk.now())
 
     def on_timeout(self):
         '''
          This is the function/method where we do the exciting stuff :-)
         '''
-
+        if self._inflight is not None:
+            # A check is still running. on_readable schedules the next one when it is done.
+            return
         # If CONFIGCHECK is not 1 a.k.a. ok, then we won't do anything. It means we have a config error.
-        if self.CONFIGCHECK == 1:
-            # Let's check our HTTP Address & REGEX and see if its up or down.
-            _web_check = self.web_check()
-            if _web_check == 1:
-                # Now we have to do all our health checking logic here...
-                # If we are here, then we are up
-                self.agentMgr.status_set("HealthStatus:", "UP")
-                if self.CURRENTSTATUS == 0:
-                    # We were down but now up,so now let's change the configuration and set CURRENTSTATUS to 1
-                    # Run CONF_RECOVER ********
-                    syslog.syslog("HTTP host back up. Changing Configuration.")
-                    self.change_config('RECOVER')
-                    self.CURRENTSTATUS = 1
-                    self.FAILITERATION = 0
-                elif self.FAILITERATION > 0:
-                    # This means we had at least one miss but we did not change config, just log and reset variable to 0
-                    syslog.syslog("HTTP host back up. Clearing FAILITERATION semaphore.")
-                    self.agentMgr.status_set("HealthStatus:", "UP")
-                    self.FAILITERATION = 0
-            elif _web_check == 0:
-                # We are down
-                self.FAILITERATION += 1
-                if self.CURRENTSTATUS == 0:
-                    # This means we've already changed config. Do nothing.
-                    pass
-                else:
-                    # These are strings, force them to ints
-                    if self.agentMgr.agent_option("FAILCOUNT"):
-                        MAXFAILCOUNT = self.agentMgr.agent_option("FAILCOUNT")
-                    else:
-                        # Else we'll use the default value of FAILCOUNT
-                        MAXFAILCOUNT=self.FAILCOUNT
-                    if int(self.FAILITERATION) >= int(MAXFAILCOUNT):
-                        # Host is definitely down. Change config.
-                        # RUN CONF_FAIL
-                        syslog.syslog("HTTP HOST is down. Changing configuration.")
-                        self.change_config('FAIL')
-                        self.agentMgr.status_set("HealthStatus:", "FAIL")
-                        self.CURRENTSTATUS = 0
+        if self.CONFIGCHECK == 1 and self._regex is None:
+            # REGEX was changed to something that does not compile, or cleared, after startup.
+            # on_agent_option has logged why. Don't run a check that can only fail.
+            self.set_status("Status:", "REGEX parameter is not valid")
+        elif self.CONFIGCHECK == 1 and not self._ipv4_valid:
+            # IPv4 was cleared or changed to something that is not an address after startup.
+            # connect would resolve a host name with a blocking lookup, and an empty address
+            # connects to the switch itself, so don't check at all.
+            self.set_status("Status:", "IPv4 parameter is not valid")
+        elif self.CONFIGCHECK == 1 and self._vrf and not self._vrf_valid:
+            # VRF is set but does not exist (yet). Don't probe from the default VRF instead.
+            # on_vrf_state picks it up once it is created.
+            self.set_status("Status:", "VRF %s does not exist" % self._vrf)
+        elif self.CONFIGCHECK == 1:
+            self.set_status("Status:", "Administratively Up")
+            # Let's check our HTTP Address & REGEX and see if its up or down. The check runs in
+            # the background so the SDK event loop is not blocked for up to HTTPTIMEOUT. The
+            # socket is created here because that needs the VrfMgr.
+            sock = self.open_socket()
+            if sock is not None:
+                s, self._checksock = sock
+                FAILING = self.FAILITERATION > 0 or self.CURRENTSTATUS == 0
+                self._check = CheckParams(self._protocol, self._server_address, self._ipv4,
+                                          self._timeout_int, self._regex, self._regexstr,
+                                          self._request, self._tlssession,
+                                          bool(self._etag or self._lastmodified))
+                self._inflight = self._pool.submit(self.web_check, s, self._check, FAILING)
+                self._inflight.add_done_callback(self.check_done)
+                return
+            self.update_health(255)
+        self.schedule_check()
+
+    def check_done(self, future):
+        '''
+        Done callback of the check Future. It runs on the worker thread, so all it does
+        is wake the SDK event loop, which picks up the result in on_readable.
+        '''
+        os.write(self._notifyfd, b"\0")
+
+    def on_readable(self, fd):
+        try:
+            os.read(self._donefd, 64)
+        except BlockingIOError:
+            pass
+        if self._inflight is None or not self._inflight.done():
+            return
+        try:
+            _web_check, TRACE, VALIDATORS, SESSION = self._inflight.result()
+        except Exception as e:
+            logger.error("%s", e)
+            _web_check, TRACE, VALIDATORS, SESSION = 255, None, None, None
+        CHECK = self._check
+        self._inflight = None
+        self._check = None
+        if self._checksock is not None:
+            self._checksock.close()
+            self._checksock = None
+        if self.CONFIGCHECK != 1:
+            # The agent was shut down while the check ran. Don't act on it.
+            return
+        if CHECK.request is self._request:
+            # Nothing the request depends on changed while the check ran, so what it
+            # learned about the page and the TLS session still applies.
+            if SESSION is not None:
+                self._tlssession = SESSION
+            if VALIDATORS is not None:
+                self.set_validators(*VALIDATORS)
+        # Acting on the result, including any config change through the EapiMgr, happens
+        # here on the SDK thread.
+        self.update_health(_web_check, TRACE)
+        self.schedule_check()
+
+    def schedule_check(self):
+        '''
+        Set the timer for the next check.
+        '''
+        # Wait for CHECKINTERVAL. If we have started missing checks but have not yet declared
+        # the host down, check again sooner so a real failure is confirmed faster.
+        if self.FAILITERATION > 0 and self.CURRENTSTATUS == 1:
+            NEXTCHECK = max(1, self._checkinterval_int // 4)
+        else:
+            NEXTCHECK = self._checkinterval_int
+        self.timeout_time_is(eossdk.now() + NEXTCHECK)
 
+    def update_health(self, _web_check, TRACE=None):
+        '''
+        Update our UP/FAIL state from the result of a web_check and change the
+        configuration when the host goes down or comes back. TRACE is what web_check
+        found, traced here because the worker thread does not use the tracer.
+        '''
+        if TRACE is not None:
+            self.tracer.trace0(TRACE)
+        if _web_check == 1:
+            # Now we have to do all our health checking logic here...
+            # If we are here, then we are up
+            self.set_status("HealthStatus:", "UP")
+            if self.CURRENTSTATUS == 0:
+                # We were down but now up,so now let's change the configuration and set CURRENTSTATUS to 1
+                # Run CONF_RECOVER ********
+                logger.log(NOTICE, MSG_HOST_UP)
+                self.change_config('RECOVER')
+                self.CURRENTSTATUS = 1
+                self.FAILITERATION = 0
+            elif self.FAILITERATION > 0:
+                # This means we had at least one miss but we did not change config, just log and reset variable to 0
+                logger.info(MSG_HOST_UP_CLEAR)
+                self.FAILITERATION = 0
+        elif _web_check == 0:
+            # We are down
+            self.FAILITERATION += 1
+            if self.CURRENTSTATUS == 0:
+                # This means we've already changed config. Do nothing.
+                pass
             else:
-                # We get here if we had some weird exception
-                syslog.syslog("TCPCheck - An exception occurred. Skipping to next interval")
+                if self.FAILITERATION >= self._failcount_int:
+                    # Host is definitely down. Change config.
+                    # RUN CONF_FAIL
+                    logger.error(MSG_HOST_DOWN)
+                    self.change_config('FAIL')
+                    self.set_status("HealthStatus:", "FAIL")
+                    self.CURRENTSTATUS = 0
 
-        # Wait for CHECKINTERVAL
-        if self.agentMgr.agent_option("CHECKINTERVAL"):
-            self.timeout_time_is(eossdk.now() + int(self.agentMgr.agent_option("CHECKINTERVAL")))
         else:
-            self.timeout_time_is(eossdk.now() + int(self.CHECKINTERVAL))
+            # We get here if we had some weird exception
+            logger.warning(MSG_CHECK_ERROR)
 
     def on_agent_option(self, optionName, value):
         # options are a key/value pair
         # Here we set the status output when user does a show agent command
-        if optionName == "IPv4":
-            if not value:
-                self.tracer.trace3("IPv4 List Deleted")
-                self.agentMgr.status_set("IPv4 Address List:", "None")
-            else:
-                self.tracer.trace3("Adding IPv4 Address list to %s" % value)
-                self.agentMgr.status_set("IPv4 Address List:", "%s" % value)
-        if optionName == "PROTOCOL":
-            if not value:
-                self.tracer.trace3("Protocol Deleted")
-                self.agentMgr.status_set("PROTOCOL:", "None")
-            else:
-                self.tracer.trace3("Adding Protocol %s" % value)
-                self.agentMgr.status_set("PROTOCOL:", "%s" % value)
-        if optionName == "TCPPORT":
-            if not value:
-                self.tracer.trace3("TCPPORT Deleted")
-                self.agentMgr.status_set("TCPPORT:", "None")
-            else:
-                self.tracer.trace3("Adding TCPPORT %s" % value)
-                self.agentMgr.status_set("TCPPORT:", "%s" % value)
-        if optionName == "USERNAME":
-            if not value:
-                self.tracer.trace3("USERNAME Deleted")
-                self.agentMgr.status_set("USERNAME:", "None")
-            else:
-                self.tracer.trace3("Adding USERNAME %s" % value)
-                self.agentMgr.status_set("USERNAME:", "%s" % value)
-        if optionName == "PASSWORD":
-            if not value:
-                self.tracer.trace3("PASSWORD Deleted")
-                self.agentMgr.status_set("PASSWORD:", "None")
-            else:
-                self.tracer.trace3("Adding PASSWORD %s" % value)
-                self.agentMgr.status_set("PASSWORD:", "%s" % value)
-        if optionName == "CONF_FAIL":
-            if not value:
-                self.tracer.trace3("CONF_FAIL Deleted")
-                self.agentMgr.status_set("CONF_FAIL:", "None")
-            else:
-                self.tracer.trace3("Adding CONF_FAIL %s" % value)
-                self.agentMgr.status_set("CONF_FAIL:", "%s" % value)
-        if optionName == "CONF_RECOVER":
-            if not value:
-                self.tracer.trace3("CONF_RECOVER Deleted")
-                self.agentMgr.status_set("CONF_RECOVER:", "None")
-            else:
-                self.tracer.trace3("Adding CONF_RECOVER %s" % value)
-                self.agentMgr.status_set("CONF_RECOVER:", "%s" % value)
-        if optionName == "REGEX":
-            if not value:
-                self.tracer.trace3("REGEX Deleted")
-                self.agentMgr.status_set("REGEX:", "None")
-            else:
-                self.tracer.trace3("Adding REGEX %s" % value)
-                self.agentMgr.status_set("REGEX:", "%s" % value)
-        if optionName == "HTTPTIMEOUT":
-            if not value:
-                self.tracer.trace3("HTTPTIMEOUT Deleted")
-                self.agentMgr.status_set("HTTPTIMEOUT:", self.HTTPTIMEOUT)
-            else:
-                self.tracer.trace3("Adding HTTPTIMEOUT %s" % value)
-                self.agentMgr.status_set("HTTPTIMEOUT:", "%s" % value)
-        if optionName == "FAILCOUNT":
-            if not value:
-                self.tracer.trace3("FAILCOUNT Deleted")
-                self.agentMgr.status_set("FAILCOUNT:", self.FAILCOUNT)
-            else:
-                self.tracer.trace3("Adding FAILCOUNT %s" % value)
-                self.agentMgr.status_set("FAILCOUNT:", "%s" % value)
-        if optionName == "CHECKINTERVAL":
-            if not value:
-                self.tracer.trace3("CHECKINTERVAL Deleted")
-                self.agentMgr.status_set("CHECKINTERVAL:", self.CHECKINTERVAL)
-            else:
-                self.tracer.trace3("Adding CHECKINTERVAL %s" % value)
-                self.agentMgr.status_set("CHECKINTERVAL:", "%s" % value)
-        if optionName == "URLPATH":
-            if not value:
-                self.tracer.trace3("URLPATH Deleted")
-                self.agentMgr.status_set("URLPATH:", "%s" % "/")
-            else:
-                self.tracer.trace3("Adding URLPATH %s" % value)
-                self.agentMgr.status_set("URLPATH:", "%s" % value)
-        if optionName == "VRF":
-            if not value:
-                self.tracer.trace3("VRF Deleted")
-                self.agentMgr.status_set("VRF:", "%s" % "Default")
-            else:
-                self.tracer.trace3("Adding VRF %s" % value)
-                self.agentMgr.status_set("VRF:", "%s" % value)
+        STATUSKEY, DEFAULT = self.OPTIONS.get(optionName, (None, None))
+        if STATUSKEY is None:
+            return
+        if DEFAULT is None:
+            # Options with a built in default show that default when unset.
+            DEFAULT = getattr(self, optionName)
+        if not value:
+            self.tracer.trace3("%s Deleted" % optionName)
+        else:
+            self.tracer.trace3("Adding %s %s" % (optionName, value))
+        self.set_status(STATUSKEY, "%s" % (value or DEFAULT))
+
+        handler = self._option_handlers.get(optionName)
+        if handler is not None:
+            handler(value)
+
+    # Setters for on_agent_option. They keep typed copies of the options web_check uses,
+    # so a check does not have to go back through the SDK for each one.
+    def _set_ipv4(self, value):
+        self._ipv4 = value
+        self._ipv4_valid = False
+        if value:
+            try:
+                socket.inet_pton(socket.AF_INET, value)
+                self._ipv4_valid = True
+            except (OSError, ValueError):
+                logger.error("IPv4 parameter %s is not a valid IPv4 address", value)
+        self._server_address = (self._ipv4, self._tcpport)
+        self.rebuild_request()
+
+    def _set_protocol(self, value):
+        self._protocol = value
+        self.rebuild_request()
+
+    def _set_tcpport(self, value):
+        self._tcpport = int(value) if value else 0
+        self._server_address = (self._ipv4, self._tcpport)
+        self.rebuild_request()
+
+    def _set_request_option(self, value):
+        # USERNAME and PASSWORD are only used to build the request.
+        self.rebuild_request()
+
+    def _set_urlpath(self, value):
+        # If URLPATH is not set, just use / for consistency. Otherwise make sure it has
+        # a leading /. A plain string test is all this needs, no regex.
+        URLPATH = value or "/"
+        self._finalpath = URLPATH if URLPATH.startswith('/') else "/%s" % URLPATH
+        self.rebuild_request()
+
+    def _set_conf_file(self, value):
+        if value:
+            # Parse the file now so it is already cached when we need it.
+            self.read_config_file(value)
+
+    def _set_regex(self, value):
+        # The response is read as raw bytes, so compile REGEX as a bytes pattern and
+        # search the buffer directly without decoding it.
+        # UTF-8 rather than latin-1, so non-ASCII text in REGEX matches pages sent as UTF-8.
+        self._regexstr = value
+        self._regex = None
+        if value:
+            try:
+                self._regex = self.compile_regex(value.encode("utf-8"))
+            except re.error as e:
+                logger.error("REGEX %s is not a valid regular expression: %s", value, e)
+        # Validators from a page that matched the old REGEX must go.
+        self.rebuild_request()
+
+    # These are strings, force them to ints once here rather than on every check.
+    def _set_httptimeout(self, value):
+        self._timeout_int = int(value or self.HTTPTIMEOUT)
+
+    def _set_failcount(self, value):
+        self._failcount_int = int(value or self.FAILCOUNT)
+
+    def _set_checkinterval(self, value):
+        self._checkinterval_int = int(value or self.CHECKINTERVAL)
+
+    def _set_vrf(self, value):
+        self._vrf = value or ""
+        self._vrf_valid = bool(value) and self.VrfMgr.exists(value)
+
+    def on_vrf_state(self, vrf_name, vrf_state):
+        if self._vrf and vrf_name == self._vrf:
+            self._vrf_valid = self.VrfMgr.exists(vrf_name)
+            self.tracer.trace0("VRF %s changed state, exists: %s" % (vrf_name, self._vrf_valid))
 
 
     def on_agent_enabled(self, enabled,reason=None):
         # When shutdown set status and then shutdown
         if not enabled:
          self.tracer.trace0("Shutting down")
+         # No more checks. on_timeout could otherwise still fire and submit to the pool
+         # after it is shut down below.
+         self.CONFIGCHECK = 0
+         if self._checksock is not None:
+             # The worker is joined at interpreter exit, so a check still in progress would
+             # hold up the exit for as long as HTTPTIMEOUT. Shutting its socket down makes the
+             # pending connect or recv return straight away.
+             try:
+                 self._checksock.shutdown(socket.SHUT_RDWR)
+             except OSError:
+                 pass
+             self._checksock.close()
+             self._checksock = None
+         self._pool.shutdown(wait=False)
          self.agentMgr.status_del("Status:")
+         self._status.pop("Status:", None)
          if reason is not None:
-             self.agentMgr.status_set("Status:", "Administratively Down - %s" % reason)
+             self.set_status("Status:", "Administratively Down - %s" % reason)
          else:
-             self.agentMgr.status_set("Status:", "Administratively Down")
+             self.set_status("Status:", "Administratively Down")
          self.agentMgr.agent_shutdown_complete_is(True)
 
+    def set_status(self, key, value):
+        '''
+        Wrapper around agentMgr.status_set that skips the call if the key already
+        shows this value.
+        '''
+        if self._status.get(key) != value:
+            self.agentMgr.status_set(key, value)
+            self._status[key] = value
+
     def check_vars(self):
         '''
         Do some basic config checking. Return 1 if all is good. Else return
@@ -383,33 +610,41 @@ class TCPCheckAgent(eossdk.AgentHandler, eossdk.TimeoutHandler, eossdk.VrfHandle
         Very basic existance testing here. Maybe add later some greater syntax testing...
         '''
         if not self.agentMgr.agent_option("TCPPORT"):
-            syslog.syslog("TCPPORT Parameter is not set. This is a mandatory parameter")
+            logger.error("TCPPORT Parameter is not set. This is a mandatory parameter")
             self.on_agent_enabled(enabled=False, reason='TCPPORT Parameter is not set')
             return 0
         if not self.agentMgr.agent_option("PROTOCOL"):
-            syslog.syslog("PROTOCOL parameter is not set. This is a mandatory parameter")
+            logger.error("PROTOCOL parameter is not set. This is a mandatory parameter")
             self.on_agent_enabled(enabled=False, reason='PROTOCOL Parameter is not set')
             return 0
         if self.agentMgr.agent_option("PROTOCOL") not in ('http', 'https'):
-            syslog.syslog("PROTOCOL parameter is not valid. Parameter must be http or https")
+            logger.error("PROTOCOL parameter is not valid. Parameter must be http or https")
             self.on_agent_enabled(enabled=False, reason='PROTOCOL parameter is not valid')
             return 0
         if not self.agentMgr.agent_option("IPv4"):
-            syslog.syslog("IPv4 parameter is not set. This is a mandatory parameter")
+            logger.error("IPv4 parameter is not set. This is a mandatory parameter")
             self.on_agent_enabled(enabled=False, reason='IPv4 parameter is not set')
             return 0
+        if not self._ipv4_valid:
+            # on_agent_option has already logged why.
+            self.on_agent_enabled(enabled=False, reason='IPv4 parameter is not valid')
+            return 0
         if not self.agentMgr.agent_option("REGEX"):
-            syslog.syslog("REGEX parameter is not set. This is a mandatory parameter")
+            logger.error("REGEX parameter is not set. This is a mandatory parameter")
             self.on_agent_enabled(enabled=False, reason='REGEX parameter is not set')
             return 0
+        if self._regex is None:
+            # on_agent_option has already logged why.
+            self.on_agent_enabled(enabled=False, reason='REGEX parameter is not valid')
+            return 0
         # Should add some basic file checking here...i.e. make sure the following files
         # actually exist.
         if not self.agentMgr.agent_option("CONF_FAIL"):
-            syslog.syslog("CONF_FAIL parameter is not set. This is a mandatory parameter")
+            logger.error("CONF_FAIL parameter is not set. This is a mandatory parameter")
             self.on_agent_enabled(enabled=False, reason='CONF_FAIL parameter is not set')
             return 0
         if not self.agentMgr.agent_option("CONF_RECOVER"):
-            syslog.syslog("CONF_RECOVER parameter is not set. This is a mandatory parameter")
+            logger.error("CONF_RECOVER parameter is not set. This is a mandatory parameter")
             self.on_agent_enabled(enabled=False, reason='CONF_RECOVER parameter is not set')
             return 0
 
@@ -417,158 +652,307 @@ class TCPCheckAgent(eossdk.AgentHandler, eossdk.TimeoutHandler, eossdk.VrfHandle
         if self.agentMgr.agent_option("CONF_FAIL"):
             CONFFAILFILE = os.path.isfile(self.agentMgr.agent_option("CONF_FAIL"))
         if not CONFFAILFILE:
-            syslog.syslog("CONF_FAIL file does NOT exist")
+            logger.error("CONF_FAIL file does NOT exist")
             self.on_agent_enabled(enabled=False, reason='CONF_FAIL file missing')
             return 0
         if self.agentMgr.agent_option("CONF_RECOVER"):
             CONFRECOVERFILE = os.path.isfile(self.agentMgr.agent_option("CONF_RECOVER"))
         if not CONFRECOVERFILE:
-            syslog.syslog("CONF_RECOVER file does NOT exist")
+            logger.error("CONF_RECOVER file does NOT exist")
             self.on_agent_enabled(enabled=False, reason='CONF_RECOVER file missing')
             return 0
 
         # If VRF option set, check to make sure it really exists.
-        if self.agentMgr.agent_option("VRF"):
-                if not self.VrfMgr.exists(self.agentMgr.agent_option("VRF")):
+        if self._vrf:
+                if not self._vrf_valid:
                     # This means the VRF does not exist
-                    syslog.syslog("VRF %s does not exist." % self.agentMgr.agent_option("VRF"))
+                    logger.error("VRF %s does not exist.", self._vrf)
                     self.on_agent_enabled(enabled=False, reason='VRF does not exist')
                     return 0
 
         # If we get here, then we're good!
         return 1
 
-    def web_check(self):
+    def rebuild_request(self):
         '''
-        This function will do HTTP/HTTPS Request and will return 1 if REGEX is found
-        or 0 if not found or there are issues.
+        Build the raw HTTP request web_check sends from the agent options, so the
+        URL, Host header and Basic auth token are only worked out when they change.
         '''
-
-        # Let's build the correct URL
-        if self.agentMgr.agent_option("URLPATH"):
-            # We have a URLPATH we need to deal with.
-            # Let's see if we have a leading / or not.
-            if re.findall('^/', self.agentMgr.agent_option("URLPATH")):
-                # This means we have a preceeding /
-                FINALPATH="%s" % self.agentMgr.agent_option("URLPATH")
-            else:
-                FINALPATH="/%s" % self.agentMgr.agent_option("URLPATH")
-        else:
-            # If we get here, it means that URLPATH is not set, so lets just add a trailing / for consistency.
-            FINALPATH="/"
-
-
         CRLF="\r\n"
 
-        # Now lets build the request
-        request = 'GET %s HTTP/1.1%s' % (FINALPATH, CRLF)
-        request += 'HOST: %s%s' % (self.agentMgr.agent_option("IPv4"), CRLF)
+        # Now lets build the request. _set_urlpath has already normalized the path.
+        request = 'GET %s HTTP/1.1%s' % (self._finalpath, CRLF)
+        request += 'HOST: %s%s' % (self._ipv4, CRLF)
         if self.agentMgr.agent_option("USERNAME"):
-            token=base64.b64encode('%s:%s' % (self.agentMgr.agent_option("USERNAME"), self.agentMgr.agent_option("PASSWORD"))).decode("ascii")
+            credentials = '%s:%s' % (self.agentMgr.agent_option("USERNAME"), self.agentMgr.agent_option("PASSWORD"))
+            token=base64.b64encode(credentials.encode("utf-8")).decode("ascii")
             request += 'Authorization: Basic %s%s' % (token, CRLF)
         request += 'Connection: close%s' % CRLF
+        self._baserequest = request
+        # The URL or server may have changed, so forget what we knew about the last page
+        # and the last TLS session.
+        self._etag = None
+        self._lastmodified = None
+        self._tlssession = None
+        self._request = (self._baserequest + CRLF).encode("utf-8")
+
+    def compile_regex(self, PATTERN):
+        '''
+        Compile PATTERN with RE2 if it is available, else with re. Patterns RE2 does not
+        support (e.g. backreferences) are also compiled with re.
+        '''
+        if re2 is not None:
+            try:
+                return re2.compile(PATTERN)
+            except re2.error:
+                self.tracer.trace0("REGEX not supported by RE2, using re")
+        return re.compile(PATTERN)
 
-
-        if self.VrfMgr.exists(self.agentMgr.agent_option("VRF")):
+    def open_socket(self):
+        '''
+        Create the TCP socket for a check, in VRF if one is set. Returns a tuple of the
+        socket and a dup of it, or None if it could not be created. The dup stays usable
+        after web_check hands the socket over to TLS, so the check can be cut short.
+        '''
+        with contextlib.ExitStack() as stack:
+            # Anything registered on stack is closed if we fail part way. On success
+            # pop_all() hands the socket over to web_check.
             try:
-                sock_fd=self.VrfMgr.socket_at(socket.AF_INET,socket.SOCK_STREAM,0,self.agentMgr.agent_option("VRF"))
-                s = socket.fromfd( sock_fd, socket.AF_INET, socket.SOCK_STREAM, 0 )
-                # Convert socket from type _socket.socket to socket._socketobject
-                s = socket.socket ( _sock=s )
+                if self._vrf_valid:
+                    sock_fd=self.VrfMgr.socket_at(socket.AF_INET,socket.SOCK_STREAM,0,self._vrf)
+                    # eossdk.VrfMgr.socket_at() provides a fileno. Wrap it directly rather
+                    # than dup it with fromfd, so the socket object is its only owner and
+                    # closing the socket closes the fileno.
+                    try:
+                        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0, fileno=sock_fd)
+                    except OSError:
+                        os.close(sock_fd)
+                        raise
+                else:
+                    s = socket.socket( socket.AF_INET, socket.SOCK_STREAM, 0 )
+                stack.enter_context(contextlib.closing(s))
+                # The request goes out in one write. Disable Nagle so it is never held back
+                # waiting on an ACK, which would show up as added latency in every check.
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sdup = s.dup()
+                stack.enter_context(contextlib.closing(sdup))
             except Exception as e:
                 # If we get an issue, lets log this because we have an issue.
-                s.close()
-                syslog.syslog("Unable to create socket. Closing sock_fd")
-                os.close(sock_fd)
-                syslog.syslog("%s" % e)
-                return 255
-        else:
+                logger.error("Unable to create socket. Closing socket.")
+                logger.error("%s", e)
+                return None
+            stack.pop_all()
+        return s, sdup
+
+    def connect_socket(self, s, ADDRESS, TIMEOUT):
+        '''
+        Connect s to ADDRESS without blocking in connect(), waiting at most TIMEOUT
+        seconds for it to complete. Returns None once connected, else the errno of why
+        it failed, errno.ETIMEDOUT if TIMEOUT ran out. s is left in blocking mode.
+        '''
+        s.setblocking(False)
+        try:
+            err = s.connect_ex(ADDRESS)
+            if err not in (0, errno.EINPROGRESS):
+                return err
+            selector = selectors.DefaultSelector()
             try:
-                s = socket.socket( socket.AF_INET, socket.SOCK_STREAM, 0 )
-            except Exception as e:
-                # If we get an issue, lets log this because we have an issue.
-                syslog.syslog("Unable to create socket. Closing socket.")
-                syslog.syslog("%s" % e)
-                s.close()
-                return 255
+                selector.register(s, selectors.EVENT_WRITE)
+                if not selector.select(TIMEOUT):
+                    return errno.ETIMEDOUT
+            finally:
+                selector.close()
+            err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                return err
+            return None
+        finally:
+            s.setblocking(True)
+
+    def web_check(self, s, CHECK, FAILING):
+        '''
+        This function will do HTTP/HTTPS Request over socket s and will return 1 if
+        REGEX is found or 0 if not found or there are issues. It runs on the worker
+        thread, so it only uses the CheckParams in CHECK and does not touch the SDK.
+        FAILING is True if checks have already been failing. s is closed before this
+        returns, however it returns.
+        Returns a tuple of the result, a trace message, the (ETag, Last-Modified) to
+        use for the next check or None to keep them, and the TLS session.
+        '''
+        session = None
+        with contextlib.ExitStack() as stack:
+            # Cleanup is registered as each resource is taken, and runs in reverse order on
+            # the way out of this block, on every return and exception path.
+            stack.enter_context(contextlib.closing(s))
+
+            # HTTPTIMEOUT bounds the whole check, not each socket call, so a server that
+            # trickles its response can not tie up the check indefinitely.
+            deadline = time.monotonic() + CHECK.timeout
+            if FAILING:
+                # Checks are already failing. Give up on the connect quickly so a dead host costs
+                # a short SYN timeout on each check instead of the full HTTPTIMEOUT.
+                connecttimeout = min(self.CONNECTTIMEOUT, CHECK.timeout)
+            else:
+                connecttimeout = CHECK.timeout
+            error = self.connect_socket(s, CHECK.address, connecttimeout)
+            if error is not None:
+                if error == errno.ETIMEDOUT:
+                    logger.warning(MSG_CONNECT_TIMEOUT)
+                else:
+                    logger.warning("Connection failed: %s", os.strerror(error))
+                # We get here if we can not establish connection to server. Return 0 same as
+                # remote host down event.
+                return 0, "Unable to connect", None, None
+
+            s.settimeout(max(deadline - time.monotonic(), 0.001))
+            if CHECK.protocol == 'https':
+                # Wrap in SSL. The socket is already connected, so this does the TLS handshake.
+                try:
+                    thesocket = self._sslcontext.wrap_socket(s, server_hostname=CHECK.hostname,
+                                                             session=CHECK.session)
+                except (ssl.SSLError, OSError) as e:
+                    # A failed handshake means the server is not answering properly. Treat it
+                    # the same as a failed connect.
+                    logger.warning("TLS handshake failed: %s", e)
+                    return 0, "TLS handshake failed", None, None
+                stack.enter_context(contextlib.closing(thesocket))
+            else:
+                # Whether we use s or thesocket, lets make thesocket be used moving forward for
+                # http connection so I'm only using one object name here for crafting HTTP or HTTPS request...
+                thesocket=s
 
-        if self.agentMgr.agent_option("PROTOCOL") == 'https':
-            # Wrap in SSL
             try:
-                thesocket = ssl.wrap_socket(s, ssl_version=ssl.PROTOCOL_TLSv1)
-            except Exception as e:
-                # If we get an issue, lets log this.
-                s.close()
-                if self.VrfMgr.exists(self.agentMgr.agent_option("VRF")):
-                    # Because eossdk.VrfMgr.socket_at() provides a fileno, we'll just
-                    # use os.close.
-                    os.close(sock_fd)
-                syslog.syslog("%s" % e)
-                return 255
+                thesocket.sendall(CHECK.request)
+            except OSError as e:
+                # Server dropped the connection before taking the request. Same as it being down.
+                logger.warning("Error sending HTTP request: %s", e)
+                return 0, "Unable to send request", None, None
+
+            # Read the response a chunk at a time and stop as soon as REGEX matches instead of
+            # pulling in the whole page first. The buffer is kept whole so ^, \A and lookbehinds
+            # still see the real start of the response, but each read only searches from the
+            # last MATCHOVERLAP bytes before it, so data is not scanned over and over. At most
+            # MAXRESPONSE bytes are read.
+            found = False
+            notmodified = False
+            received = 0
+            headers = None
+            pagecontent = bytearray()
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(MSG_RESPONSE_TIMEOUT)
+                    break
+                try:
+                    thesocket.settimeout(remaining)
+                    chunk = thesocket.recv(self.PACKETSIZE)
+                except OSError as e:
+                    # Includes socket.timeout and ssl.SSLError.
+                    logger.warning("Error reading HTTP response: %s", e)
+                    break
+                if not chunk:
+                    break
+                received += len(chunk)
+                searchfrom = max(0, len(pagecontent) - self.MATCHOVERLAP)
+                headerfrom = max(0, len(pagecontent) - 3)
+                pagecontent.extend(chunk)
+                if headers is None:
+                    headerend = pagecontent.find(b"\r\n\r\n", headerfrom)
+                    if headerend >= 0:
+                        status, headers = self.parse_headers(pagecontent[:headerend])
+                        if status == 304 and CHECK.conditional:
+                            # Page has not changed since REGEX last matched. No body follows.
+                            notmodified = True
+                            break
+                if CHECK.regex.search(pagecontent, searchfrom):
+                    found = True
+                    break
+                if received >= self.MAXRESPONSE:
+                    break
+
+            if CHECK.protocol == 'https':
+                # Keep the session for the next check. Taken after the read so TLS 1.3 tickets,
+                # which arrive after the handshake, are included.
+                session = thesocket.session
+
+        # We could just return if we got a page. But it is more accurate to require the
+        # Regex match so we know that things are legitimate.
+
+        REGEX = CHECK.regexstr
+
+        if notmodified:
+            return 1, "Page not modified since REGEX %s was found" % REGEX, None, session
+        if received:
+            if found:
+                if headers is not None:
+                    VALIDATORS = (headers.get("etag"), headers.get("last-modified"))
+                else:
+                    VALIDATORS = None
+                return 1, "REGEX %s found" % REGEX, VALIDATORS, session
+            elif received >= self.MAXRESPONSE:
+                return 0, "Read %s bytes without a REGEX match, giving up" % received, (None, None), session
+            else:
+                return 0, "REGEX %s NOT found" % REGEX, (None, None), session
         else:
-            # Whether we use s or thesocket, lets make thesocket be used moving forward for
-            # http connection so I'm only using one object name here for crafting HTTP or HTTPS request...
-            thesocket=s
-
-
+            return 0, "WEB Content is blank", None, session
 
-        # Define server address and port
-        serverAddress = ( self.agentMgr.agent_option("IPv4"), int(self.agentMgr.agent_option("TCPPORT")) )
-        # Set timeout.
-        if self.agentMgr.agent_option("HTTPTIMEOUT"):
-            thesocket.settimeout(int(self.agentMgr.agent_option("HTTPTIMEOUT")))
-        else:
-            thesocket.settimeout(int(self.HTTPTIMEOUT))
+    def parse_headers(self, HEAD):
+        '''
+        Split the raw header block of an HTTP response into its status code and a dict
+        of lower cased header names to values. Status is 0 if the status line is garbled.
+        '''
+        lines = bytes(HEAD).decode("latin-1").split("\r\n")
         try:
-            thesocket.connect( serverAddress )
-        except:
-            syslog.syslog("Connection Timeout")
-            thesocket.close()
-            if self.VrfMgr.exists(self.agentMgr.agent_option("VRF")):
-                # Because eossdk.VrfMgr.socket_at() provides a fileno, we'll just
-                # use os.close.
-                os.close(sock_fd)
-            # We get here if we can not establish connection to server. Return 0 same as
-            # remote host down event.
-            return 0
-
-        thesocket.send(CRLF+request+CRLF+CRLF)
-        pagecontent = thesocket.recv(self.PACKETSIZE)
-        # pagecontent is a string, so I should be able to clean up sockets now.
-        # and get that out of the way.
-
-        # Cleanup
-        thesocket.shutdown(socket.SHUT_RD)
-        thesocket.close()
-        if self.agentMgr.agent_option("PROTOCOL") == 'https':
-            # Need to close the TCP socket too. Closing ssl socket doesn't always do this
-            # If we get here, we had a legit SSL & TCP socket.
-            s.shutdown(socket.SHUT_RD)
-            s.close()
-        if self.VrfMgr.exists(self.agentMgr.agent_option("VRF")):
-            # Because eossdk.VrfMgr.socket_at() provides a fileno, we'll just
-            # use os.close.
-            os.close(sock_fd)
-
-
-
-
-        # We could just return here because we got a page. But it would be more accurate
-        # to do a Regex on the content so we know that things are legitimate.
-
-        REGEX = self.agentMgr.agent_option("REGEX")
-
-        # Now lets do regex match to make sure we got what was expected.
-        if pagecontent:
-            if re.findall(REGEX, pagecontent):
-                self.tracer.trace0("REGEX %s found" % REGEX)
-                return 1
-            else:
-                self.tracer.trace0("REGEX %s NOT found" % REGEX)
-                return 0
-        else:
-            self.tracer.trace0("WEB Content is blank")
-            return 0
+            status = int(lines[0].split()[1])
+        except (IndexError, ValueError):
+            status = 0
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return status, headers
+
+    def set_validators(self, ETAG, LASTMODIFIED):
+        '''
+        Remember the ETag/Last-Modified of a page that matched REGEX and rebuild the
+        request so the next check is a conditional GET. Pass None to clear them.
+        '''
+        if ETAG == self._etag and LASTMODIFIED == self._lastmodified:
+            return
+        self._etag = ETAG
+        self._lastmodified = LASTMODIFIED
+        request = self._baserequest
+        if ETAG:
+            request += 'If-None-Match: %s\r\n' % ETAG
+        if LASTMODIFIED:
+            request += 'If-Modified-Since: %s\r\n' % LASTMODIFIED
+        self._request = (request + '\r\n').encode("utf-8")
+
+    def read_config_file(self, CONFFILE):
+        '''
+        Return the list of commands in a CONF_FAIL or CONF_RECOVER file. The parsed list
+        is cached per file and only re-read when the file's mtime changes. Returns None
+        if the file can not be read. check_vars reports missing files.
+        '''
+        try:
+            mtime = os.stat(CONFFILE).st_mtime
+            cached = self._cmd_cache.get(CONFFILE)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+            with open(CONFFILE) as fh:
+                data = fh.read()
+        except (IOError, OSError) as e:
+            self.tracer.trace0("Unable to read %s: %s" % (CONFFILE, e))
+            self._cmd_cache.pop(CONFFILE, None)
+            return None
+        # Strip out the whitespace and drop blank lines, which eAPI would reject as commands.
+        configfile = [line for line in (x.strip() for x in data.splitlines()) if line]
+
+        # Check to make sure user has not specified 'enable' as the first command. This will error in command mode
+        if configfile and configfile[0] == 'enable':
+            del configfile[0]
+        self._cmd_cache[CONFFILE] = (mtime, configfile)
+        return configfile
 
     def change_config(self, STATUS):
         '''
@@ -576,52 +960,37 @@ class TCPCheckAgent(eossdk.AgentHandler, eossdk.TimeoutHandler, eossdk.VrfHandle
         If STATUS is FAIL, then run CONF_FAIL via eAPI API
         If STATUS RECOVER (or else) then run CONF_RECOVER via eAPI API
         '''
-        CONF_FAIL = self.agentMgr.agent_option("CONF_FAIL")
-        CONF_RECOVER = self.agentMgr.agent_option("CONF_RECOVER")
         if STATUS == 'FAIL':
             self.tracer.trace0("Status FAIL. Applying config changes")
-            with open(CONF_FAIL) as fh:
-                configfile = fh.readlines()
-            # Strip out the whitespace
-            configfile = [x.strip() for x in configfile]
-
-            # Check to make sure user has not specified 'enable' as the first command. This will error  in command mode
-            if configfile[0] == 'enable':
-                del configfile[0]
-            # Now apply config changes
-            try:
-                applyconfig = self.EapiMgr.run_config_cmds([z for z in configfile])
-                if(applyconfig.success()):
-                    syslog.syslog("Applied Configuration changes from %s" % CONF_FAIL)
-                else:
-                    syslog.syslog("Unable to apply configuration changes from %s" % CONF_FAIL)
-                    syslog.syslog("%s" % applyconfig.error_message())
-            except:
-                syslog.syslog("Unable to apply config via eAPI interaction module in EOS SDK.")
-                return 0
+            CONFFILE = self.agentMgr.agent_option("CONF_FAIL")
         else:
             self.tracer.trace0("Status Recover. Applying config changes.")
-            with open(CONF_RECOVER) as fh:
-                configfile = fh.readlines()
-            # Strip out the whitespace
-            configfile = [x.strip() for x in configfile]
-
-            # Check to make sure user has not specified 'enable' as the first command. This will error in command mode
-            if configfile[0] == 'enable':
-                del configfile[0]
-
-            # Now apply config changes
-            try:
-                applyconfig = self.EapiMgr.run_config_cmds([z for z in configfile])
-                if(applyconfig.success()):
-                    syslog.syslog("Applied Configuration changes from %s" % CONF_RECOVER)
-                else:
-                    syslog.syslog("Unable to apply configuration changes from %s" % CONF_RECOVER)
-                    syslog.syslog("%s" % applyconfig.error_message())
-            except:
-                syslog.syslog("Unable to apply config via eAPI interaction module in EOS SDK.")
-                return 0
+            CONFFILE = self.agentMgr.agent_option("CONF_RECOVER")
+        return self.apply_config(CONFFILE, self.read_config_file(CONFFILE))
 
+    def apply_config(self, CONFFILE, configfile):
+        '''
+        Apply the list of commands read from CONFFILE via the eAPI interaction module.
+        Return 1 if the commands were sent, 0 if there was nothing usable to send or
+        eAPI raised an error.
+        '''
+        if configfile is None:
+            logger.error("Unable to read configuration changes from %s", CONFFILE)
+            return 0
+        # Now apply config changes
+        try:
+            applyconfig = self.EapiMgr.run_config_cmds(configfile)
+            if(applyconfig.success()):
+                logger.info("Applied Configuration changes from %s", CONFFILE)
+            else:
+                logger.error("Unable to apply configuration changes from %s", CONFFILE)
+                logger.error("%s", applyconfig.error_message())
+        except Exception as e:
+            # The SDK has no exception type of its own for this, but a bare except would also
+            # catch SystemExit and KeyboardInterrupt. Log what went wrong too.
+            logger.error("Unable to apply config via eAPI interaction module in EOS SDK.")
+            logger.error("%s", e)
+            return 0
         return 1
 
 
@@ -629,11 +998,26 @@ class TCPCheckAgent(eossdk.AgentHandler, eossdk.TimeoutHandler, eossdk.VrfHandle
 # MAIN
 #=============================================
 def main():
-    syslog.openlog(ident="TCPCheck-ALERT-AGENT", logoption=syslog.LOG_PID, facility=syslog.LOG_LOCAL4)
-    sdk = eossdk.Sdk()
-    TCPCheck = TCPCheckAgent(sdk, sdk.get_timeout_mgr(),sdk.get_vrf_mgr(),sdk.get_eapi_mgr())
-    sdk.main_loop(sys.argv)
-    # Run the agent until terminated by a signal
+    # Syslog with LOCAL4 so logs show up in EOS logs. The agent only puts messages on
+    # logqueue, the listener thread does the actual writes to /dev/log.
+    handler = logging.handlers.SysLogHandler(address="/dev/log",
+                                             facility=logging.handlers.SysLogHandler.LOG_LOCAL4)
+    handler.ident = "TCPCheck-ALERT-AGENT[%d]: " % os.getpid()
+    # Same format syslog.syslog() used to send, without the NUL logging adds by default.
+    handler.append_nul = False
+    handler.priority_map = dict(handler.priority_map, NOTICE="notice")
+    logqueue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(logqueue, handler)
+    logger.addHandler(logging.handlers.QueueHandler(logqueue))
+    logger.setLevel(logging.INFO)
+    listener.start()
+    try:
+        sdk = eossdk.Sdk()
+        TCPCheck = TCPCheckAgent(sdk, sdk.get_timeout_mgr(),sdk.get_vrf_mgr(),sdk.get_eapi_mgr())
+        sdk.main_loop(sys.argv)
+        # Run the agent until terminated by a signal
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":